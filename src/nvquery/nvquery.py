@@ -1,6 +1,15 @@
+import ctypes
+import multiprocessing
+import os
 import pynvml
-from pynvml import _nvmlSamplingType_t
-from time import sleep
+import statistics
+import struct
+import threading
+from array import array
+from multiprocessing.shared_memory import SharedMemory
+from pynvml import _nvmlSamplingType_t, _nvmlValueType_t, c_nvmlSample_t
+from time import monotonic, sleep
+from typing import Optional
 
 
 _SAMPLE_VALUE_TYPE_TO_FIELD = {
@@ -13,6 +22,27 @@ _SAMPLE_VALUE_TYPE_TO_FIELD = {
     6: "usVal",
 }
 
+# struct format characters matching the members of the nvmlValue_t union
+_SAMPLE_VALUE_TYPE_TO_FORMAT = {
+    0: "d",
+    1: "I",
+    2: "L",
+    3: "Q",
+    4: "q",
+    5: "i",
+    6: "H",
+}
+
+_VALID_SAMPLING_TYPES = frozenset(
+    {
+        pynvml.NVML_TOTAL_POWER_SAMPLES,
+        pynvml.NVML_MEMORY_UTILIZATION_SAMPLES,
+        pynvml.NVML_GPU_UTILIZATION_SAMPLES,
+        pynvml.NVML_PROCESSOR_CLK_SAMPLES,
+        pynvml.NVML_MEMORY_CLK_SAMPLES,
+    }
+)
+
 _SAMPLING_TYPE_TO_HEADER = {
     pynvml.NVML_TOTAL_POWER_SAMPLES: "Power",
     pynvml.NVML_MEMORY_UTILIZATION_SAMPLES: "Memory Util",
@@ -21,63 +51,425 @@ _SAMPLING_TYPE_TO_HEADER = {
     pynvml.NVML_MEMORY_CLK_SAMPLES: "Memory Clk",
 }
 
+# Power readings (in mW) fetched together by print_current_snapshot
+_SNAPSHOT_FIELDS = {
+    pynvml.NVML_FI_DEV_POWER_INSTANT: "Power",
+    pynvml.NVML_FI_DEV_POWER_AVERAGE: "Avg Power",
+    pynvml.NVML_FI_DEV_POWER_CURRENT_LIMIT: "Power Limit",
+}
+
+# Used when the update period of a device cannot be measured
+_DEFAULT_POLL_INTERVAL_MS = 10
+
+# Appending lets the formatter process share the logs with this process
+_LOG_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND
+
+# Logs are only read after the run, so every this many bytes written they are
+# evicted from the page cache where supported (not on macOS or Windows)
+_DROP_CACHE_BYTES = 1 << 20
+_HAVE_FADVISE = hasattr(os, "posix_fadvise")
+
+
+def _write_all(fd, data):
+    """Write all of data to a raw file descriptor."""
+    with memoryview(data) as view:
+        while view:
+            view = view[os.write(fd, view) :]
+
+
+def _batch_formatter(sample_value_type):
+    """Return a function formatting a batch of samples as CSV rows."""
+    row = (
+        b"%d,%a\n"
+        if sample_value_type == pynvml.NVML_VALUE_TYPE_DOUBLE
+        else b"%d,%d\n"
+    )
+
+    def format_batch(timestamps, values):
+        # Interleave timestamps and values and format the whole batch with a
+        # single % on the repeated row template
+        fields = [None] * (2 * len(timestamps))
+        fields[::2] = timestamps
+        fields[1::2] = values
+        return row * len(timestamps) % tuple(fields)
+
+    return format_batch
+
+
+def _decode_samples(buffer, value_format):
+    """Split a buffer of nvmlSample_t into lists of timestamps and values.
+
+    Both fields are picked out with strided memoryview casts, so the samples
+    are decoded in C instead of one structure at a time.
+    """
+    raw = buffer.cast("B")
+    sample_size = ctypes.sizeof(c_nvmlSample_t)
+    timestamp_size = ctypes.sizeof(ctypes.c_ulonglong)
+    value_size = struct.calcsize(value_format)
+    value_offset = c_nvmlSample_t.sampleValue.offset
+    timestamps = raw.cast("Q")[:: sample_size // timestamp_size].tolist()
+    values = raw.cast(value_format)[
+        value_offset // value_size :: sample_size // value_size
+    ].tolist()
+    return timestamps, values
+
+
+def _median_period_ms(timestamps):
+    """Median time in ms between sample timestamps, None if there are none."""
+    intervals = [
+        later - earlier
+        for earlier, later in zip(timestamps, timestamps[1:])
+        if later > earlier
+    ]
+    if not intervals:
+        return None
+    # Sample timestamps are in microseconds
+    return statistics.median(intervals) / 1e3
+
+
+def _sample_buffer(handle, sampling_type, timestamp=0):
+    """Allocate an array for the samples NVML holds for a device.
+
+    With the default timestamp of 0 the array fits all buffered samples.
+    """
+    c_sample_value_type = _nvmlValueType_t()
+    c_sample_count = ctypes.c_uint(0)
+    fn = pynvml._nvmlGetFunctionPointer("nvmlDeviceGetSamples")
+    ret = fn(
+        handle,
+        _nvmlSamplingType_t(sampling_type),
+        ctypes.c_ulonglong(timestamp),
+        ctypes.byref(c_sample_value_type),
+        ctypes.byref(c_sample_count),
+        None,
+    )
+    if ret != pynvml.NVML_SUCCESS:
+        raise pynvml.NVMLError(ret)
+    return (c_nvmlSample_t * c_sample_count.value)()
+
+
+def _get_samples(handle, sampling_type, timestamp, samples=None):
+    """Same as pynvml.nvmlDeviceGetSamples, but returns the raw ctypes buffer.
+
+    pynvml converts the sample array into a list of structure objects, which
+    forces decoding every sample in Python. The returned memoryview can instead
+    be decoded in one go with _decode_samples.
+
+    If a preallocated samples array is passed, it is filled in a single call
+    instead of first querying the sample count and allocating a new array.
+    """
+    c_sampling_type = _nvmlSamplingType_t(sampling_type)
+    c_timestamp = ctypes.c_ulonglong(timestamp)
+    # NVML may record new samples between sizing the array and reading it, so
+    # an array allocated here is resized until the read fits.
+    allocate = samples is None
+    fn = pynvml._nvmlGetFunctionPointer("nvmlDeviceGetSamples")
+    while True:
+        if allocate:
+            samples = _sample_buffer(handle, sampling_type, timestamp)
+        c_sample_value_type = _nvmlValueType_t()
+        c_sample_count = ctypes.c_uint(len(samples))
+        ret = fn(
+            handle,
+            c_sampling_type,
+            c_timestamp,
+            ctypes.byref(c_sample_value_type),
+            ctypes.byref(c_sample_count),
+            samples,
+        )
+        if not (allocate and ret == pynvml.NVML_ERROR_INSUFFICIENT_SIZE):
+            break
+    if ret != pynvml.NVML_SUCCESS:
+        raise pynvml.NVMLError(ret)
+    return (
+        c_sample_value_type.value,
+        memoryview(samples)[: c_sample_count.value],
+    )
+
+
+class _SampleRing:
+    """Fixed-capacity ring buffer of samples with one producer and one consumer.
+
+    Timestamps and values are kept in two separate typed arrays. Only the
+    producer advances head and only the consumer advances tail, so the sampler
+    thread never waits on the writer thread. Samples that do not fit are
+    dropped instead of overwriting ones that were not written yet.
+
+    The arrays live in one buffer, which can be shared memory so that the
+    producer and consumer run in different processes. In that case head and
+    tail must be a multiprocessing.Array: its lock is a memory barrier, which
+    makes the samples visible to the other process before the counter that
+    publishes them, also on weakly ordered CPUs.
+    """
+
+    __slots__ = ("capacity", "mask", "_counters", "timestamps", "values")
+
+    def __init__(self, capacity, value_format, buffer=None, counters=None):
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError("Ring buffer capacity must be a power of two")
+        self.capacity = capacity
+        self.mask = capacity - 1
+        if buffer is None:
+            buffer = bytearray(self.nbytes(capacity, value_format))
+        buffer = memoryview(buffer)
+        values_start = 8 * capacity
+        values_end = values_start + capacity * struct.calcsize(value_format)
+        self._counters = array("Q", [0, 0]) if counters is None else counters
+        self.timestamps = buffer[:values_start].cast("Q")
+        self.values = buffer[values_start:values_end].cast(value_format)
+
+    @staticmethod
+    def nbytes(capacity, value_format):
+        """Size of the buffer backing the timestamp and value arrays."""
+        return capacity * (8 + struct.calcsize(value_format))
+
+    @property
+    def head(self):
+        return self._counters[0]
+
+    @head.setter
+    def head(self, value):
+        self._counters[0] = value
+
+    @property
+    def tail(self):
+        return self._counters[1]
+
+    @tail.setter
+    def tail(self, value):
+        self._counters[1] = value
+
+    def push(self, timestamps, values):
+        """Append samples, returning how many were dropped."""
+        head = self.head
+        count = min(len(timestamps), self.capacity - (head - self.tail))
+        if count:
+            start = head & self.mask
+            split = min(count, self.capacity - start)
+            self.timestamps[start : start + split] = array(
+                "Q", timestamps[:split]
+            )
+            self.values[start : start + split] = array(
+                self.values.format, values[:split]
+            )
+            if split < count:
+                self.timestamps[: count - split] = array(
+                    "Q", timestamps[split:count]
+                )
+                self.values[: count - split] = array(
+                    self.values.format, values[split:count]
+                )
+            self.head = head + count
+        return len(timestamps) - count
+
+    def pop(self):
+        """Remove all buffered samples and return their timestamps and values."""
+        head = self.head
+        tail = self.tail
+        start = tail & self.mask
+        end = start + head - tail
+        if end <= self.capacity:
+            timestamps = self.timestamps[start:end].tolist()
+            values = self.values[start:end].tolist()
+        else:
+            end &= self.mask
+            timestamps = (
+                self.timestamps[start:].tolist()
+                + self.timestamps[:end].tolist()
+            )
+            values = self.values[start:].tolist() + self.values[:end].tolist()
+        self.tail = head
+        return timestamps, values
+
+    def release(self):
+        """Release the views on the backing buffer so it can be closed."""
+        self.timestamps.release()
+        self.values.release()
+
+
+class _LogWriter:
+    """Formats sample batches and writes them to the per-device logs."""
+
+    __slots__ = ("logs", "_format_batch", "_cached_bytes")
+
+    def __init__(self, logs, sample_value_type):
+        self.logs = logs
+        self._format_batch = _batch_formatter(sample_value_type)
+        self._cached_bytes = array("Q", [0]) * len(logs)
+
+    def write(self, id, timestamps, values):
+        log = self.logs[id]
+        data = self._format_batch(timestamps, values)
+        _write_all(log, data)
+        self._cached_bytes[id] += len(data)
+        if _HAVE_FADVISE and self._cached_bytes[id] >= _DROP_CACHE_BYTES:
+            # Starts writeback of dirty pages and drops the clean ones, pages
+            # still being written are picked up by the next call
+            os.posix_fadvise(log, 0, 0, os.POSIX_FADV_DONTNEED)
+            self._cached_bytes[id] = 0
+
+    def drain(self, buffers):
+        for id, buffer in enumerate(buffers):
+            if buffer.head != buffer.tail:
+                self.write(id, *buffer.pop())
+
+
+def _format_process(
+    log_names,
+    memory_names,
+    counters,
+    capacity,
+    sample_value_type,
+    interval,
+    stop_event,
+):
+    """Entry point of the formatter process started by NvmlReader.start."""
+    value_format = _SAMPLE_VALUE_TYPE_TO_FORMAT[sample_value_type]
+    memories = []
+    buffers = []
+    logs = []
+    try:
+        for name in memory_names:
+            memories.append(SharedMemory(name))
+        for memory, device_counters in zip(memories, counters):
+            buffers.append(
+                _SampleRing(
+                    capacity, value_format, memory.buf, device_counters
+                )
+            )
+        for name in log_names:
+            logs.append(os.open(name, os.O_WRONLY | os.O_APPEND))
+        writer = _LogWriter(logs, sample_value_type)
+        while not stop_event.wait(interval):
+            writer.drain(buffers)
+        writer.drain(buffers)
+    finally:
+        for log in logs:
+            os.close(log)
+        for buffer in buffers:
+            buffer.release()
+        for memory in memories:
+            memory.close()
+
 
 class NvmlReader:
+    __slots__ = (
+        "sampling_type",
+        "device_count",
+        "handles",
+        "logs",
+        "_log_names",
+        "last_sample_time",
+        "field",
+        "_sample_value_type",
+        "_value_format",
+        "_sample_buffers",
+        "_writer",
+        "poll_intervals_ms",
+        "metric",
+        "buffer_capacity",
+        "buffers",
+        "_memory_clocks",
+        "_graphics_clocks",
+        "_stop_event",
+        "_threads",
+        "_shared_memory",
+        "_formatter",
+        "_formatter_stop",
+    )
+
     def __init__(
         self,
         log_file_base_name: str = "log",
         sampling_type: _nvmlSamplingType_t = pynvml.NVML_TOTAL_POWER_SAMPLES,
+        poll_interval_ms: Optional[int] = None,
+        buffer_capacity: int = 1 << 16,
     ):
-        if sampling_type not in [
-            pynvml.NVML_TOTAL_POWER_SAMPLES,
-            pynvml.NVML_MEMORY_UTILIZATION_SAMPLES,
-            pynvml.NVML_GPU_UTILIZATION_SAMPLES,
-            pynvml.NVML_PROCESSOR_CLK_SAMPLES,
-            pynvml.NVML_MEMORY_CLK_SAMPLES,
-        ]:
+        if sampling_type not in _VALID_SAMPLING_TYPES:
             raise ValueError("Illegal or unsupported sampling type")
         self.sampling_type = sampling_type
         pynvml.nvmlInit()
         self.device_count = pynvml.nvmlDeviceGetCount()
         self.handles = []
+        # Raw file descriptors, batches are written with a single os.write
         self.logs = []
-        self.last_sample_time = []
+        self._log_names = []
+        # Per-device counters, one typed array slot per device
+        self.last_sample_time = array("Q", [0]) * self.device_count
         for device_id in range(self.device_count):
             self.handles.append(pynvml.nvmlDeviceGetHandleByIndex(device_id))
-        if len(self.handles) != self.device_count:
-            raise RuntimeError("Failed to get all device handles")
         for idx, _ in enumerate(self.handles):
             filename = log_file_base_name + "_" + str(idx) + ".csv"
-            self.logs.append(open(filename, "w"))
-            self.last_sample_time.append(0)
-        # Perform test read on first device to get sampling_type
-        sample_value_type, _ = pynvml.nvmlDeviceGetSamples(
-            device=self.handles[0],
-            sampling_type=self.sampling_type,
-            timeStamp=0,
-        )
+            self.logs.append(os.open(filename, _LOG_FLAGS, 0o644))
+            # Absolute, so the formatter process finds the logs even if the
+            # working directory changes before start
+            self._log_names.append(os.path.abspath(filename))
+        # A single read per device of all samples NVML holds gives the value
+        # type, the size of the sample array to reuse for every later read
+        # and the update period of the device
+        probes = [
+            self._probe_device(id, handle)
+            for id, handle in enumerate(self.handles)
+        ]
+        succeeded = [probe for probe in probes if probe is not None]
+        if not succeeded:
+            raise RuntimeError("Failed to read samples from any device")
+        sample_value_type = succeeded[0][0]
         self.field = _SAMPLE_VALUE_TYPE_TO_FIELD.get(sample_value_type)
+        self._sample_value_type = sample_value_type
+        self._value_format = _SAMPLE_VALUE_TYPE_TO_FORMAT[sample_value_type]
+        # Reused for every read instead of allocating a new array per call,
+        # allocated on the first read for devices whose probe failed
+        self._sample_buffers = [
+            None if probe is None else probe[1] for probe in probes
+        ]
+        self._writer = _LogWriter(self.logs, sample_value_type)
+        # Polling faster than NVML updates its readings yields no new samples,
+        # so by default poll each device at half its measured update period.
+        # About every other poll then finds nothing new, which _read_samples
+        # treats as an empty read rather than an error.
+        if poll_interval_ms is None:
+            self.poll_intervals_ms = []
+            for probe in probes:
+                period_ms = None if probe is None else probe[2]
+                self.poll_intervals_ms.append(
+                    _DEFAULT_POLL_INTERVAL_MS
+                    if period_ms is None
+                    else max(1, period_ms / 2)
+                )
+        else:
+            self.poll_intervals_ms = [
+                max(1, poll_interval_ms)
+            ] * self.device_count
         self.metric = _SAMPLING_TYPE_TO_HEADER.get(sampling_type)
+        # Samples handed from the sampler thread to the writer, set up by start
+        self.buffer_capacity = buffer_capacity
+        self.buffers = []
+        self._memory_clocks = {}
+        self._graphics_clocks = {}
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._shared_memory = []
+        self._formatter = None
+        self._formatter_stop = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
         for log in self.logs:
-            log.close()
+            os.close(log)
+        pynvml.nvmlShutdown()
 
     def print_clocks(self):
         for id, handle in enumerate(self.handles):
             print(f" Device: {id} ".center(80, "="))
             print("Memory Clock - Possible Compute Clocks")
-            supported_memory_clocks = (
-                pynvml.nvmlDeviceGetSupportedMemoryClocks(handle)
-            )
+            supported_memory_clocks = self._supported_memory_clocks(id)
             for memory_clock in supported_memory_clocks:
-                supported_compute_clocks = (
-                    pynvml.nvmlDeviceGetSupportedGraphicsClocks(
-                        handle, memory_clock
-                    )
+                supported_compute_clocks = self._supported_graphics_clocks(
+                    id, memory_clock
                 )
                 print("-" * 80)
                 print(
@@ -86,10 +478,28 @@ class NvmlReader:
                 print(f"{pynvml.nvmlDeviceGetCurrentClockFreqs(handle)}")
 
     def print_arch(self):
-        for id, handle in enumerate(self.handles):
+        for id, _ in enumerate(self.handles):
             print(
-                f"Device {id}: Arch: {pynvml.nvmlDeviceGetSupportedGraphicsClocks(handle, 1215)}"
+                f"Device {id}: Arch: {self._supported_graphics_clocks(id, 1215)}"
+            )
+
+    def _supported_memory_clocks(self, id):
+        # Supported clocks are static per device, only query them once
+        if id not in self._memory_clocks:
+            self._memory_clocks[id] = (
+                pynvml.nvmlDeviceGetSupportedMemoryClocks(self.handles[id])
             )
+        return self._memory_clocks[id]
+
+    def _supported_graphics_clocks(self, id, memory_clock):
+        key = (id, memory_clock)
+        if key not in self._graphics_clocks:
+            self._graphics_clocks[key] = (
+                pynvml.nvmlDeviceGetSupportedGraphicsClocks(
+                    self.handles[id], memory_clock
+                )
+            )
+        return self._graphics_clocks[key]
 
     def print_current_clock(self):
         for id, handle in enumerate(self.handles):
@@ -119,12 +529,27 @@ class NvmlReader:
             power = pynvml.nvmlDeviceGetPowerUsage(handle)
             print(f"Device {id}: Power: {power / 1e3}W")
 
+    def print_current_snapshot(self):
+        field_ids = list(_SNAPSHOT_FIELDS)
+        for id, handle in enumerate(self.handles):
+            # One NVML call per device for all fields
+            values = pynvml.nvmlDeviceGetFieldValues(handle, field_ids)
+            readings = []
+            for value in values:
+                name = _SNAPSHOT_FIELDS[value.fieldId]
+                if value.nvmlReturn != pynvml.NVML_SUCCESS:
+                    readings.append(f"{name} n/a")
+                    continue
+                field = _SAMPLE_VALUE_TYPE_TO_FIELD[value.valueType]
+                readings.append(f"{name} {getattr(value.value, field) / 1e3}W")
+            print(f"Device {id}: {', '.join(readings)}")
+
     def print_current_samples(self):
         for id, handle in enumerate(self.handles):
             _, samples = pynvml.nvmlDeviceGetSamples(
                 device=handle,
                 sampling_type=self.sampling_type,
-                timeStamp=self.last_mem_sample_time,
+                timeStamp=self.last_sample_time[id],
             )
             print(
                 f"{len(samples)} samples "
@@ -132,27 +557,212 @@ class NvmlReader:
             )
 
     def log_header(self):
-        header_string = f"Time,{self.metric}\n"
+        header = f"Time,{self.metric}\n".encode()
         for log in self.logs:
-            log.write(header_string)
+            _write_all(log, header)
 
     def log_samples(self):
+        self._check_not_sampling()
+        read_samples = self._read_samples
+        write_samples = self._writer.write
         for id, handle in enumerate(self.handles):
-            try:
-                _, samples = pynvml.nvmlDeviceGetSamples(
-                    device=handle,
-                    sampling_type=self.sampling_type,
-                    timeStamp=self.last_sample_time[id],
+            timestamps, values = read_samples(id, handle)
+            if timestamps:
+                write_samples(id, timestamps, values)
+
+    def start(self, format_process: bool = False):
+        """Continuously poll all devices in a background thread.
+
+        Samples are queued per device and written to the logs by a second
+        thread, so neither the caller nor the polling is blocked on file IO.
+        With format_process, the queues are placed in shared memory and a
+        separate process formats and writes them instead, so CSV formatting
+        never holds this process's GIL.
+
+        While the sampler runs, log_samples and set_last_seen raise a
+        RuntimeError, as they would race it for the same sample buffers.
+        """
+        if self._threads:
+            raise RuntimeError("Sampler is already running")
+        self._stop_event.clear()
+        self._threads = [threading.Thread(target=self._poll_loop, daemon=True)]
+        if format_process:
+            size = _SampleRing.nbytes(self.buffer_capacity, self._value_format)
+            self._shared_memory = [
+                SharedMemory(create=True, size=size) for _ in self.handles
+            ]
+            counters = [
+                multiprocessing.Array("Q", 2) for _ in self._shared_memory
+            ]
+            self.buffers = [
+                _SampleRing(
+                    self.buffer_capacity,
+                    self._value_format,
+                    memory.buf,
+                    device_counters,
                 )
-                self.last_sample_time[id] = samples[-1].timeStamp
-                for sample in samples:
-                    self.logs[id].write(
-                        f"{sample.timeStamp},{getattr(sample.sampleValue, self.field)}\n"
-                    )
-            except pynvml.NVMLError as e:
-                print(f"WARNING nvml error during sampling device {id}: {e}")
+                for memory, device_counters in zip(
+                    self._shared_memory, counters
+                )
+            ]
+            self._formatter_stop = multiprocessing.Event()
+            self._formatter = multiprocessing.Process(
+                target=_format_process,
+                args=(
+                    self._log_names,
+                    [memory.name for memory in self._shared_memory],
+                    counters,
+                    self.buffer_capacity,
+                    self._sample_value_type,
+                    min(self.poll_intervals_ms) / 1e3,
+                    self._formatter_stop,
+                ),
+                daemon=True,
+            )
+            self._formatter.start()
+        else:
+            self.buffers = [
+                _SampleRing(self.buffer_capacity, self._value_format)
+                for _ in self.handles
+            ]
+            self._threads.append(
+                threading.Thread(target=self._write_loop, daemon=True)
+            )
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Stop the background threads and write out all queued samples."""
+        if not self._threads:
+            return
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._formatter is not None:
+            # Only stop the formatter once nothing is pushed anymore, it
+            # drains the buffers a last time before exiting
+            self._formatter_stop.set()
+            self._formatter.join()
+            exitcode = self._formatter.exitcode
+            self._formatter = None
+            for buffer in self.buffers:
+                buffer.release()
+            for memory in self._shared_memory:
+                memory.close()
+                memory.unlink()
+            self._shared_memory = []
+            self.buffers = []
+            if exitcode != 0:
+                raise RuntimeError(
+                    f"Formatter process exited with code {exitcode}, "
+                    "samples were not written"
+                )
+        else:
+            self._writer.drain(self.buffers)
+            self.buffers = []
+
+    def _check_not_sampling(self):
+        if self._threads:
+            raise RuntimeError("Sampler is running")
+
+    def _poll_loop(self):
+        intervals = [
+            interval_ms / 1e3 for interval_ms in self.poll_intervals_ms
+        ]
+        next_poll = [0.0] * self.device_count
+        # Bind everything used per iteration to locals once
+        devices = list(
+            zip(
+                range(self.device_count), self.handles, self.buffers, intervals
+            )
+        )
+        read_samples = self._read_samples
+        stopped = self._stop_event.is_set
+        wait = self._stop_event.wait
+        formatter = self._formatter
+        while not stopped():
+            if formatter is not None and not formatter.is_alive():
+                print(
+                    "WARNING formatter process exited with code "
+                    f"{formatter.exitcode}, stopping sampling"
+                )
+                return
+            now = monotonic()
+            for id, handle, buffer, interval in devices:
+                if now < next_poll[id]:
+                    continue
+                next_poll[id] = now + interval
+                timestamps, values = read_samples(id, handle)
+                if timestamps:
+                    dropped = buffer.push(timestamps, values)
+                    if dropped:
+                        print(
+                            f"WARNING dropped {dropped} samples of device {id}"
+                        )
+            wait(max(0.0, min(next_poll) - monotonic()))
+
+    def _write_loop(self):
+        interval = min(self.poll_intervals_ms) / 1e3
+        while not self._stop_event.wait(interval):
+            self._writer.drain(self.buffers)
+
+    def _probe_device(self, id, handle):
+        """Read all samples NVML holds for a device once.
+
+        Returns the sample value type, the sample array to reuse for later
+        reads and the device's update period in ms, or None if the read fails.
+        """
+        try:
+            sample_value_type, buffer = _get_samples(
+                handle, self.sampling_type, 0
+            )
+        except pynvml.NVMLError as e:
+            print(f"WARNING nvml error probing device {id}: {e}")
+            return None
+        timestamps, _ = _decode_samples(
+            buffer, _SAMPLE_VALUE_TYPE_TO_FORMAT[sample_value_type]
+        )
+        return sample_value_type, buffer.obj, _median_period_ms(timestamps)
+
+    def _fill_sample_buffer(self, id, handle, timestamp):
+        if self._sample_buffers[id] is None:
+            # Probing failed at construction, allocate on first successful read
+            self._sample_buffers[id] = _sample_buffer(
+                handle, self.sampling_type
+            )
+        try:
+            _, buffer = _get_samples(
+                handle, self.sampling_type, timestamp, self._sample_buffers[id]
+            )
+        except pynvml.NVMLError_InsufficientSize:
+            # NVML holds more samples than when the buffer was allocated
+            self._sample_buffers[id] = _sample_buffer(
+                handle, self.sampling_type
+            )
+            _, buffer = _get_samples(
+                handle, self.sampling_type, timestamp, self._sample_buffers[id]
+            )
+        return buffer
+
+    def _read_samples(self, id, handle):
+        """Return the timestamps and values of the new samples of a device."""
+        last_sample_time = self.last_sample_time
+        try:
+            buffer = self._fill_sample_buffer(id, handle, last_sample_time[id])
+        except pynvml.NVMLError_NotFound:
+            # No samples newer than the last one read yet
+            return [], []
+        except pynvml.NVMLError as e:
+            print(f"WARNING nvml error during sampling device {id}: {e}")
+            return [], []
+        timestamps, values = _decode_samples(buffer, self._value_format)
+        if timestamps:
+            last_sample_time[id] = timestamps[-1]
+        return timestamps, values
 
     def set_last_seen(self):
+        self._check_not_sampling()
         for id, handle in enumerate(self.handles):
             try:
                 _, samples = pynvml.nvmlDeviceGetSamples(
@@ -0,0 +1,64 @@
+from pynvml import c_nvmlSample_t
+
+from nvquery.nvquery import (
+    _SAMPLE_VALUE_TYPE_TO_FIELD,
+    _SAMPLE_VALUE_TYPE_TO_FORMAT,
+    _batch_formatter,
+    _decode_samples,
+    _SampleRing,
+)
+
+
+def test_ring_push_pop():
+    ring = _SampleRing(8, "I")
+    assert ring.push([1, 2, 3], [10, 20, 30]) == 0
+    assert ring.pop() == ([1, 2, 3], [10, 20, 30])
+    assert ring.pop() == ([], [])
+
+
+def test_ring_wraps():
+    ring = _SampleRing(4, "I")
+    ring.push([1, 2, 3], [10, 20, 30])
+    ring.pop()
+    assert ring.push([4, 5, 6], [40, 50, 60]) == 0
+    assert ring.pop() == ([4, 5, 6], [40, 50, 60])
+
+
+def test_ring_wraps_and_drops_on_overflow():
+    ring = _SampleRing(4, "I")
+    ring.push([1, 2], [10, 20])
+    ring.pop()
+    ring.push([3, 4, 5], [30, 40, 50])
+    ring.pop()
+    # Starts at slot 1, wraps around the end and drops what does not fit
+    assert ring.push([6, 7, 8, 9, 10, 11], [60, 70, 80, 90, 100, 110]) == 2
+    assert ring.pop() == ([6, 7, 8, 9], [60, 70, 80, 90])
+    assert ring.push([12], [120]) == 0
+    assert ring.pop() == ([12], [120])
+
+
+def test_ring_drops_when_full():
+    ring = _SampleRing(2, "I")
+    assert ring.push([1, 2, 3], [10, 20, 30]) == 1
+    assert ring.push([4], [40]) == 1
+    assert ring.pop() == ([1, 2], [10, 20])
+
+
+def test_decode_samples_all_value_types():
+    samples = (c_nvmlSample_t * 3)()
+    for sample_value_type, field in _SAMPLE_VALUE_TYPE_TO_FIELD.items():
+        for i, sample in enumerate(samples):
+            sample.timeStamp = 1000 + i
+            setattr(sample.sampleValue, field, i + 1)
+        timestamps, values = _decode_samples(
+            memoryview(samples)[:2],
+            _SAMPLE_VALUE_TYPE_TO_FORMAT[sample_value_type],
+        )
+        assert timestamps == [1000, 1001]
+        assert values == [1, 2]
+
+
+def test_batch_formatter():
+    assert _batch_formatter(1)([1, 2], [10, 20]) == b"1,10\n2,20\n"
+    assert _batch_formatter(0)([1], [0.5]) == b"1,0.5\n"
+    assert _batch_formatter(3)([], []) == b""